@@ -1,2 +1,3 @@
-from .compiler import generate_sql_query, get_compiled_cube_fields
+from .compiler import generate_sql_query, generate_parameterized_sql_query, get_compiled_cube_fields, \
+    get_query_fingerprint
 from .cube import load_cube_configs
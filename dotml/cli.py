@@ -1,12 +1,14 @@
 import os
+import sqlite3
 from typing import Optional
 
 import json5 as json
 import typer
 from typing_extensions import Annotated
 
-from dotml.compiler import generate_sql_query, get_compiled_cube_fields
+from dotml.compiler import generate_sql_query, generate_parameterized_sql_query, get_compiled_cube_fields
 from dotml.cube import load_cube_configs
+from dotml.value_index import DimensionValueIndex, get_indexed_dimensions
 
 app = typer.Typer()
 
@@ -17,6 +19,8 @@ def get_first_cubes(path: Optional[str]) -> dict:
         path = os.getcwd()
 
     r_cubes = load_cube_configs(dir_path=path)
+    if len(r_cubes) > 1:
+        typer.echo(f"Found {len(r_cubes)} models, using the first one", err=True)
     if len(r_cubes) > 0:
         return r_cubes[0]
     else:
@@ -49,13 +53,17 @@ def compiled_fields(cube_name: str, path: Annotated[Optional[str], typer.Argumen
     if len(cubes) > 0:
         cube = [cube for cube in cubes.get('cubes', []) if cube.get('name') == cube_name]
         if len(cube) > 0:
-            compiled_fields = get_compiled_cube_fields(cube[0])
-            typer.echo('\n'.join([field for field in compiled_fields]))
+            # variant names are generated one at a time
+            for field in get_compiled_cube_fields(cube[0]):
+                typer.echo(field)
         else:
             typer.echo(f"Cube {cube_name} not found")
 
 @app.command()
-def query(query: str, path: Annotated[Optional[str], typer.Argument()] = None):
+def query(query: str, path: Annotated[Optional[str], typer.Argument()] = None,
+          canonical: Annotated[bool, typer.Option(
+              help="Emit canonical sql with a fingerprint, columns in field name order")] = False,
+          paramstyle: Annotated[Optional[str], typer.Option(help="Emit placeholders: qmark, numeric, named, ...")] = None):
     print(query)
     try:
         query_dict = json.loads(query)
@@ -66,8 +74,44 @@ def query(query: str, path: Annotated[Optional[str], typer.Argument()] = None):
     cubes = get_first_cubes(path)
     
     if len(cubes) > 1:
-        sql = generate_sql_query(cubes, query_dict)
-        typer.echo(sql)
+        if paramstyle is not None:
+            sql, parameters = generate_parameterized_sql_query(cubes, query_dict, paramstyle, canonical=canonical)
+            typer.echo(sql)
+            typer.echo(json.dumps(parameters, quote_keys=True))
+        else:
+            sql = generate_sql_query(cubes, query_dict, canonical=canonical)
+            typer.echo(sql)
+
+
+@app.command()
+def values(dimension: Annotated[str, typer.Argument(help="cube.dimension or 'all' for all indexed dimensions")],
+           path: Annotated[Optional[str], typer.Argument()] = None,
+           database: Annotated[Optional[str], typer.Option(help="sqlite database to load the values from")] = None,
+           prefix: Annotated[str, typer.Option(help="only values starting with this prefix")] = ''):
+    cubes = get_first_cubes(path)
+    if len(cubes) == 0:
+        return
+    dimensions = get_indexed_dimensions(cubes) if dimension == 'all' else [dimension]
+
+    def execute(sql: str):
+        with sqlite3.connect(database) as conn:
+            return conn.execute(sql).fetchall()
+
+    index = DimensionValueIndex(cubes, execute)
+    if database is None:
+        # without a database, print the queries that load the values
+        for d in dimensions:
+            typer.echo(index.get_values_query(d))
+        return
+
+    for d in dimensions:
+        try:
+            dimension_values = index.refresh(d)[d]
+        except ValueError as e:
+            typer.echo(str(e))
+            continue
+        typer.echo(f"{d}: " + ', '.join([str(v) for v in dimension_values.search(prefix)]) +
+                   (' (truncated)' if dimension_values.truncated else ''))
 
 
 if __name__ == "__main__":
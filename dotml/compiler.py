@@ -1,11 +1,32 @@
-import random
+import hashlib
+import itertools
 import re
-import string
+from collections import ChainMap
+from collections.abc import Mapping
 from string import Template
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 variable_pattern = re.compile(r"\$\{([a-zA-Z0-9_.]+)}")
 
+# variables, string literals and number literals of a filter, variables are kept as they are
+filter_literal_pattern = re.compile(r"(\$\{[^}]*})|('(?:[^']|'')*')|(?<![\w.])(\d+(?:\.\d+)?)(?![\w.])")
+parameter_marker_pattern = re.compile(r"@@(\d+)@@")
+
+# literals that are part of a type can not be bound, e.g. date '2024-01-01', interval '7' day or varchar(10)
+typed_literal_pattern = re.compile(r"\b(date|time|timestamp|datetime|interval)\s*$", re.IGNORECASE)
+type_arguments_pattern = re.compile(
+    r"\b(varchar|char|character|nvarchar|nchar|varbinary|binary|string|bytes|decimal|numeric|bignumeric|number|"
+    r"float|double|time|timestamp|datetime|datetime2)\s*$", re.IGNORECASE)
+
+# placeholders of the DB-API paramstyles, i is the position of the parameter starting at 1
+paramstyles = {
+    'qmark': '?',
+    'numeric': ':{i}',
+    'named': ':p{i}',
+    'format': '%s',
+    'pyformat': '%(p{i})s',
+}
+
 
 def substitute_variables(template: str, variables: Dict, recursive=True, i=0) -> str:
     # check if template contains variables
@@ -24,58 +45,131 @@ def substitute_variables(template: str, variables: Dict, recursive=True, i=0) ->
     return compiled_string
 
 
-def expand_variants(cube_fields: Dict) -> Dict:
-    additional_fields = {}
-    fields_to_remove = []
-
-    # resolve variants, go through all fields and add variants to cube_fields
-    for cf_key in cube_fields:
-        cube_field = cube_fields[cf_key]
-        if cube_field.get('variants') is not None:
-            for variant in cube_field['variants']:
-                # variant is a dict with one key and a list of values
-                # extract the key as name and the values as list
-                variant_name = list(variant.keys())[0]
-                variant_values = variant[variant_name]
-                for variant_value in variant_values:
-                    # if variant_value is a dict, extract they key as name and the value as sql
-                    if isinstance(variant_value, dict):
-                        key_name = list(variant_value.keys())[0]
-                        variant_value = variant_value[key_name]
-                    else:
-                        key_name = variant_value
-
-                    variant_field = {
-                        'name': cube_field['name'] + '_' + str(key_name),
-                        'sql': substitute_variables(cube_field['sql'], {variant_name: str(variant_value)},
-                                                    recursive=False),
-                        'dim': cube_field['dim']
-                    }
-                    additional_fields[variant_field['name']] = variant_field
-            # remove original field
-            fields_to_remove.append(cf_key)
-
-    # remove fields that have variants
-    for field_to_remove in fields_to_remove:
-        del cube_fields[field_to_remove]
-
-    # add fields variant fields
-    cube_fields = {**cube_fields, **additional_fields}
-    return cube_fields
+def get_variant_values(variant: Dict) -> Tuple[str, List[Tuple[str, str]]]:
+    """name of a variant and its values as (key, sql) pairs"""
+    # variant is a dict with one key and a list of values
+    # extract the key as name and the values as list
+    variant_name = list(variant.keys())[0]
+    values = []
+    for variant_value in variant[variant_name]:
+        # if variant_value is a dict, extract they key as name and the value as sql
+        if isinstance(variant_value, dict):
+            key_name = list(variant_value.keys())[0]
+            values.append((str(key_name), str(variant_value[key_name])))
+        else:
+            values.append((str(variant_value), str(variant_value)))
+    return variant_name, values
+
+
+def get_variant_field(cube_field: Dict, keys: Tuple[str, ...]) -> Dict:
+    """the field of one combination of variant keys, e.g. ('month',) of booking_date is booking_date_month"""
+    sql_variables = {}
+    for variant, key in zip(cube_field['variants'], keys):
+        variant_name, values = get_variant_values(variant)
+        sql_variables[variant_name] = dict(values)[key]
+    variant_field = {k: v for k, v in cube_field.items() if k != 'variants'}
+    variant_field['name'] = '_'.join([cube_field['name']] + list(keys))
+    variant_field['sql'] = substitute_variables(cube_field['sql'], sql_variables, recursive=False)
+    return variant_field
+
+
+def parse_variant_keys(suffix: str, variants: List[Dict]) -> Optional[Tuple[str, ...]]:
+    """split a name suffix like month_usd into one key per variant, None if it does not match"""
+    if len(variants) == 0:
+        return () if suffix == '' else None
+    _, values = get_variant_values(variants[0])
+    for key, _ in values:
+        if suffix == key and len(variants) == 1:
+            return key,
+        if suffix.startswith(key + '_'):
+            rest = parse_variant_keys(suffix[len(key) + 1:], variants[1:])
+            if rest is not None:
+                return (key,) + rest
+    return None
+
+
+class CubeFields(Mapping):
+    """
+    fields of a cube by name, variants are resolved when they are asked for
+
+    a field with variants, e.g. booking_date with time_frame [day, month] and currency [usd, eur], stands for
+    booking_date_day_usd, booking_date_month_eur, ... Only the requested combinations are built.
+    """
+
+    def __init__(self, fields: Dict):
+        self.fields = fields
+        self.resolved = {}
+
+    def __getitem__(self, name: str) -> Dict:
+        field = self.fields.get(name)
+        if field is not None and field.get('variants') is None:
+            return field
+        if name in self.resolved:
+            return self.resolved[name]
+        for field_name, field in self.fields.items():
+            if field.get('variants') is not None and name.startswith(field_name + '_'):
+                keys = parse_variant_keys(name[len(field_name) + 1:], field['variants'])
+                if keys is not None:
+                    self.resolved[name] = get_variant_field(field, keys)
+                    return self.resolved[name]
+        raise KeyError(name)
+
+    def __iter__(self) -> Iterator[str]:
+        # fields without variants first, then all variant names, one at a time
+        for field_name, field in self.fields.items():
+            if field.get('variants') is None:
+                yield field_name
+        for field_name, field in self.fields.items():
+            if field.get('variants') is not None:
+                keys = [[key for key, _ in get_variant_values(variant)[1]] for variant in field['variants']]
+                for combination in itertools.product(*keys):
+                    yield '_'.join((field_name,) + combination)
+
+    def __len__(self) -> int:
+        length = 0
+        for field in self.fields.values():
+            combinations = 1
+            for variant in field.get('variants') or []:
+                combinations *= len(get_variant_values(variant)[1])
+            length += combinations
+        return length
 
 
 def get_table_alias(table_name: str, other_table_aliases=None) -> str:
-    # get last part of the table name and add random string to it
+    # get last part of the table name and add a counter to it if it is already taken
+    # the alias only depends on the model, so the same query always compiles to the same sql
     if other_table_aliases is None:
         other_table_aliases = []
 
-    table_alias = table_name.split('.')[-1]
-    if table_alias in other_table_aliases:
-        random_part = ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
-        table_alias += '_' + random_part
+    base_alias = table_name.split('.')[-1]
+    table_alias = base_alias
+    i = 2
+    while table_alias in other_table_aliases:
+        table_alias = f"{base_alias}_{i}"
+        i += 1
     return table_alias
 
 
+quoted_pattern = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+
+def normalize_whitespace(sql: str) -> str:
+    """collapse all whitespace outside of quoted literals and identifiers to single spaces"""
+    # re.split with a capturing group keeps the quoted parts on the odd positions
+    parts = re.split(quoted_pattern, sql)
+    parts = [part if i % 2 == 1 else re.sub(r"\s+", ' ', part) for i, part in enumerate(parts)]
+    return ''.join(parts).strip()
+
+
+def get_query_fingerprint(sql: str) -> str:
+    """stable hash of a compiled query, insensitive to whitespace"""
+    return hashlib.sha256(normalize_whitespace(sql).encode('utf-8')).hexdigest()[:16]
+
+
+def add_fingerprint(sql: str) -> str:
+    return f"/* dotml fingerprint: {get_query_fingerprint(sql)} */ {sql}"
+
+
 def get_cube_fields(cube: Dict) -> Dict:
     cube_fields = {f['name']: {**f, 'dim': True} for f in cube.get('dimensions', [])}
     cube_fields = {**cube_fields, **{f['name']: {**f, 'dim': False} for f in cube.get('metrics', [])}}
@@ -84,29 +178,89 @@ def get_cube_fields(cube: Dict) -> Dict:
     return cube_fields
 
 
-def get_compiled_cube_fields(cube: Dict) -> dict:
-    cube_fields = get_cube_fields(cube)
-    # expand variants
-    cube_fields = expand_variants(cube_fields)
-    # return list of field names
-    return cube_fields
+def get_compiled_cube_fields(cube: Dict) -> CubeFields:
+    # variants are resolved on demand
+    return CubeFields(get_cube_fields(cube))
+
+
+class FieldVariables(Mapping):
+    """
+    variables of a cube for substitute_variables: table, field names (e.g ${revenue} - ${cost})
+    and identifiers (e.g. ${orders.total}, first replace to ${orders__total} should resolve to sql)
+    """
+
+    def __init__(self, table: str, table_alias: str, cube_fields: Mapping):
+        self.table = table
+        self.table_alias = table_alias
+        self.cube_fields = cube_fields
+
+    def __getitem__(self, key: str) -> str:
+        if key == 'table':
+            return self.table_alias
+        field_name = key[len(self.table) + 2:] if key.startswith(f"{self.table}__") else key
+        if field_name in self.cube_fields:
+            return self.cube_fields[field_name].get('sql')
+        if key in self.cube_fields:  # a field name that starts with the table name
+            return self.cube_fields[key].get('sql')
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        yield 'table'
+        yield from self.cube_fields
+        for field_name in self.cube_fields:
+            yield f"{self.table}__{field_name}"
+
+    def __len__(self) -> int:
+        return 1 + 2 * len(self.cube_fields)
 
 
-def get_simple_variables(table: str, table_alias: str, cube_fields: Dict) -> Dict:
-    field_variables = {cf: cube_fields[cf].get('sql') for cf in cube_fields}  # e.g ${revenue} - ${cost}
-    # identifier_variables e.g. ${orders.total}, first replace to ${orders__total} should resolve to sql
-    identifier_variables = {f"{table}__{cf}": cube_fields[cf].get('sql') for cf in cube_fields}
-    variables = {**{'table': table_alias}, **field_variables, **identifier_variables}
-    return variables
+class SubstitutedVariables(Mapping):
+    """variables whose values are substituted with the variables themselves on access"""
+
+    def __init__(self, variables: Mapping):
+        self.variables = variables
+
+    def __getitem__(self, key: str) -> str:
+        return substitute_variables(self.variables[key], self.variables)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.variables)
+
+    def __len__(self) -> int:
+        return len(self.variables)
+
+
+def get_simple_variables(table: str, table_alias: str, cube_fields: Mapping) -> Mapping:
+    return FieldVariables(table, table_alias, cube_fields)
+
+
+def prepare_cube(cube: Dict, other_table_aliases: List[str]) -> Dict:
+    """annotate a cube with its compiled fields, alias, variables, always filters and primary key"""
+    # variant fields are resolved on demand, fields compiled before (e.g. by a registry) are reused
+    if cube.get('cube_fields') is None:
+        cube['cube_fields'] = CubeFields(get_cube_fields(cube))
+    cube['alias'] = get_table_alias(cube.get('name'), other_table_aliases)
+    other_table_aliases.append(cube['alias'])
+    cube['cube_vars'] = get_simple_variables(table=cube.get('name'),
+                                             cube_fields=cube.get('cube_fields'),
+                                             table_alias=cube.get('alias'))
+    cube['always_where_conditions'] = [substitute_variables(af, cube['cube_vars']) for af in
+                                       cube.get('always_filter', [])]
+
+    # get primary key of each cube
+    cube['pk'] = [f for f in cube['dimensions'] if f.get('primary_key', False)]
+    if len(cube['pk']) == 0:
+        raise ValueError(f"Cube {cube.get('name')} has no primary key defined.")
+    return cube
 
 
 def simple_query(cube: Dict, fields: List[str], filters: List[str], sorts: List[str], limit: Optional[int]) -> str:
     """a simple query does not require joins"""
 
-    cube_fields = get_cube_fields(cube)
-
-    # add fields variant fields
-    cube_fields = expand_variants(cube_fields)
+    # variant fields are resolved on demand, fields compiled before (e.g. by a registry) are reused
+    cube_fields = cube.get('cube_fields')
+    if cube_fields is None:
+        cube_fields = CubeFields(get_cube_fields(cube))
 
     table_alias = get_table_alias(cube.get('name'))
 
@@ -118,7 +272,8 @@ def simple_query(cube: Dict, fields: List[str], filters: List[str], sorts: List[
     for query_field in fields:
         field_name = query_field.split('.')[1]
         if field_name in cube_fields:
-            cube_field = cube_fields[field_name]
+            # copy the field, compiled fields are shared between queries
+            cube_field = {**cube_fields[field_name]}
             if cube_field.get('window', False):
                 # resolve window function  // just use alias name; so replace ${revenue} with revenue
                 cube_field['sql'] = cube_field['sql'].replace('${', '').replace('}', '')
@@ -224,25 +379,8 @@ def join_query(cubes: List[Dict], joins: List[Dict], fields: List[str], filters:
         # check if all cubes have a join
         if cube.get('join') is None:
             raise ValueError(f"Cube {cube.get('name')} has no join defined")
-        # also calculate all cube_fields
-        cube_fields = get_cube_fields(cube)
-
-        # add fields variant fields
-        cube_fields = expand_variants(cube_fields)
-
-        cube['cube_fields'] = cube_fields
-        cube['alias'] = get_table_alias(cube.get('name'), other_table_aliases)
-        other_table_aliases.append(cube['alias'])
-        cube['cube_vars'] = get_simple_variables(table=cube.get('name'),
-                                                 cube_fields=cube.get('cube_fields'),
-                                                 table_alias=cube.get('alias'))
-        cube['always_where_conditions'] = [substitute_variables(af, cube['cube_vars']) for af in
-                                           cube.get('always_filter', [])]
-
-        # get primary key of each cube
-        cube['pk'] = [f for f in cube['dimensions'] if f.get('primary_key', False)]
-        if len(cube['pk']) == 0:
-            raise ValueError(f"Cube {cube.get('name')} has no primary key defined.")
+        # also calculate all cube_fields, alias, variables and primary key
+        prepare_cube(cube, other_table_aliases)
 
         # get list of queried dimensions in cube
         queried_dimensions = {}
@@ -250,7 +388,7 @@ def join_query(cubes: List[Dict], joins: List[Dict], fields: List[str], filters:
             cube_name, field_name = query_field.split('.')
             if cube_name == cube.get('name') and field_name in cube['cube_fields'] and cube['cube_fields'][
                 field_name].get('dim'):
-                cube_field = cube['cube_fields'][field_name]
+                cube_field = {**cube['cube_fields'][field_name]}
                 cube_field['cube'] = cube
                 cube_field['sql'] = substitute_variables(cube_field['sql'], cube.get('cube_vars'))
                 queried_dimensions[field_name] = cube_field
@@ -311,7 +449,7 @@ def join_query(cubes: List[Dict], joins: List[Dict], fields: List[str], filters:
                         from_expr += f""" {join_type} join {needed_cube.get('table')} as {needed_cube.get('alias')}
                         on {on_sql}"""
                         if needed_cube.get('always_where_conditions') is not None and len(
-                                cube.get('always_where_conditions')) > 0:
+                                needed_cube.get('always_where_conditions')) > 0:
                             additional_where_expr = " and ".join(needed_cube.get('always_where_conditions'))
                             where_expr = f"{where_expr} and {additional_where_expr}" if where_expr != "" else additional_where_expr
 
@@ -350,7 +488,7 @@ group by {group_expr}
         for query_field in all_query_fields:
             cube_name, field_name = query_field.split('.')
             if cube_name == cube.get('name') and field_name in cube['cube_fields']:
-                cube_field = cube['cube_fields'][field_name]
+                cube_field = {**cube['cube_fields'][field_name]}
                 cube_field['cube'] = cube
                 cube_field['sql'] = substitute_variables(cube_field['sql'], cube.get('cube_vars'))
                 queried_fields[field_name] = cube_field
@@ -430,15 +568,8 @@ group by {group_expr}
 
     where_expr = ''
     if filters:
-        all_cube_vars = {}
-        for cube in cubes:
-            cube_vars = cube.get('cube_vars')
-            # substitute all cube values with its variables first
-            new_cube_vars = {}
-            for k, v in cube_vars.items():
-                new_cube_vars[k] = substitute_variables(v, cube.get('cube_vars'))
-
-            all_cube_vars.update(new_cube_vars)
+        # substitute all cube values with its variables first, later cubes take precedence
+        all_cube_vars = ChainMap(*[SubstitutedVariables(cube.get('cube_vars')) for cube in reversed(cubes)])
 
         where_expr = 'where '
         where_expr += ' and '.join([f"({substitute_variables(f.replace('.', '__'), all_cube_vars)})" for f in filters])
@@ -472,7 +603,17 @@ select {select_expr}
     return query
 
 
-def generate_sql_query(cubes_config: Dict, query: Dict) -> str:
+def generate_sql_query(cubes_config: Dict, query: Dict, canonical: bool = False,
+                       cube_fields: Optional[Dict[str, CubeFields]] = None) -> str:
+    """
+    compile a query dict to sql
+
+    cube_fields are the compiled fields by cube name, e.g. kept by a ModelRegistry, otherwise they are compiled here.
+    with canonical=True, semantically identical queries compile to the exact same sql text:
+    fields and filters are ordered, whitespace is normalized and a fingerprint comment is prepended.
+    The result columns follow the ordered fields, not the order of query['fields'].
+    This lets result caches of warehouses (e.g. Snowflake, BigQuery) hit across tools.
+    """
     # 1. validate query
 
     # read query
@@ -481,26 +622,20 @@ def generate_sql_query(cubes_config: Dict, query: Dict) -> str:
     sorts = query.get('sorts', [])
     limit = query.get('limit', 5000)
 
-    # read cubes
-    cubes = cubes_config.get('cubes', [])
+    if canonical:
+        # the order of fields only changes the order of the result columns, sorts however change the rows
+        fields = sorted(set(fields))
+
+    # read cubes, copy them because compiling annotates the cube dicts (joins, aliases, ...)
+    cubes = [{**cube} for cube in cubes_config.get('cubes', [])]
     joins = cubes_config.get('joins', [])
 
-    # create a list of all dimensions and metrics names
-    # we need to merge all cubes dimensions and metrics first, then extract the names as cubename + . + fieldname
-    all_fields = []
-    for cube in cubes:
-        for cube_field in (cube.get('dimensions', []) + cube.get('metrics', []) + cube.get('window_metrics', [])):
-            if cube_field.get('variants') is None:
-                all_fields.append(cube['name'] + '.' + cube_field['name'])
-            else:
-                for variant in cube_field['variants']:
-                    variant_name = list(variant.keys())[0]
-                    variant_values = variant[variant_name]
-                    for variant_value in variant_values:
-                        # if variant value is a dict, only take the first key
-                        if isinstance(variant_value, dict):
-                            variant_value = list(variant_value.keys())[0]
-                        all_fields.append(cube['name'] + '.' + cube_field['name'] + '_' + str(variant_value))
+    # fields of all cubes by cube name, variants such as booking_date_month are resolved when they are validated
+    all_fields = cube_fields
+    if all_fields is None:
+        all_fields = {cube['name']: CubeFields(get_cube_fields(cube)) for cube in cubes}
+    # the compiled fields are reused when the cubes are prepared
+    cubes = [{**cube, 'cube_fields': all_fields[cube['name']]} for cube in cubes]
 
     # Validate fields
     needed_cubes = []
@@ -514,11 +649,12 @@ def generate_sql_query(cubes_config: Dict, query: Dict) -> str:
     sort_fields = [sf.split(' ')[0] for sf in sorts]
 
     all_query_fields = fields + filter_fields + sort_fields  # only take the first part of the sort field
+    if canonical:
+        all_query_fields = sorted(set(all_query_fields))
     for field in all_query_fields:
-        if field not in all_fields:
+        cube_name, _, field_name = field.partition('.')
+        if cube_name not in all_fields or field_name not in all_fields[cube_name]:
             raise ValueError(f"Field '{field}' does not exist in the cubes.")
-        # split the field by . and get the first element to get the cube name
-        cube_name = field.split('.')[0]
         if cube_name not in needed_cubes:
             needed_cubes.append(cube_name)
 
@@ -531,11 +667,104 @@ def generate_sql_query(cubes_config: Dict, query: Dict) -> str:
 
     # todo alternative: if a filter contains a metric field, we could add a having clause to the query
 
+    if canonical:
+        # filters are combined with 'and', so their order does not matter
+        filters = sorted(set(filters))
+
+    if query.get('sample') is not None:
+        # read the base tables of the query through a sample
+        from dotml.sampling import sample_cubes
+        cubes = sample_cubes(cubes, joins, needed_cubes, query['sample'], cubes_config.get('dialect'))
+
     if len(needed_cubes) == 0:
         raise ValueError(f"No cubes needed to generate the query. This is a bug.")
     elif len(needed_cubes) == 1:
         cube = [cube for cube in cubes if cube.get('name') == needed_cubes[0]][0]
-        return simple_query(cube, fields, filters, sorts, limit)
+        sql = simple_query(cube, fields, filters, sorts, limit)
     else:
         cubes = [cube for cube in cubes if cube.get('name') in needed_cubes]
-        return join_query(cubes, joins, fields, filters, sorts, limit, all_query_fields)
+        # the planner builds on the helpers of this module, so it is imported here
+        from dotml.planner import plan_join_query
+        sql = plan_join_query(cubes, joins, fields, filters, sorts, limit, all_query_fields,
+                              strategy_name=query.get('fan_out_strategy'))
+
+    if canonical:
+        sql = normalize_whitespace(sql)
+        sql = add_fingerprint(sql)
+    return sql
+
+
+def is_value_position(fil: str, position: int) -> bool:
+    """whether a literal at position of a filter is a value, not part of a type like date '...' or decimal(10, 2)"""
+    preceding = fil[:position]
+    if re.search(typed_literal_pattern, preceding) is not None:
+        return False
+    # find the parenthesis that encloses the literal and check if it belongs to a type
+    depth = 0
+    for i in range(len(preceding) - 1, -1, -1):
+        if preceding[i] == ')':
+            depth += 1
+        elif preceding[i] == '(':
+            if depth == 0:
+                return re.search(type_arguments_pattern, preceding[:i]) is None
+            depth -= 1
+    return True
+
+
+def extract_filter_literals(fil: str, parameters: List) -> str:
+    """replace the literals of a filter with markers like @@0@@ and collect their values in parameters"""
+
+    def replace(match) -> str:
+        if match.group(1) is not None:
+            return match.group(1)
+        if not is_value_position(fil, match.start()):
+            return match.group(0)
+        if match.group(2) is not None:
+            value = match.group(2)[1:-1].replace("''", "'")
+        else:
+            value = float(match.group(3)) if '.' in match.group(3) else int(match.group(3))
+        parameters.append(value)
+        return f"@@{len(parameters) - 1}@@"
+
+    return re.sub(filter_literal_pattern, replace, fil)
+
+
+def generate_parameterized_sql_query(cubes_config: Dict, query: Dict, paramstyle: str = 'qmark',
+                                     canonical: bool = False, cube_fields: Optional[Dict[str, CubeFields]] = None
+                                     ) -> Tuple[str, Union[List, Dict]]:
+    """
+    compile a query dict to sql with placeholders for the literals of filters and the limit
+
+    returns the sql and its parameters, a list for positional paramstyles (qmark, numeric, format) and a dict
+    for named ones (named, pyformat). The same query with other values compiles to the same sql, so prepared
+    statements and plan caches of the database can be reused.
+    """
+    if paramstyle not in paramstyles:
+        raise ValueError(f"Paramstyle '{paramstyle}' is not supported, use one of {', '.join(paramstyles)}.")
+
+    values = []
+    filters = [extract_filter_literals(f, values) for f in query.get('filters', [])]
+    parameterized_query = {**query, 'filters': filters}
+    if query.get('limit', 5000) is not None:
+        values.append(query.get('limit', 5000))
+        parameterized_query['limit'] = f"@@{len(values) - 1}@@"
+    sql = generate_sql_query(cubes_config, parameterized_query, canonical=canonical, cube_fields=cube_fields)
+
+    if paramstyle in ('format', 'pyformat'):
+        sql = sql.replace('%', '%%')  # percent signs of the sql itself, e.g. in strftime('%Y')
+
+    # number the placeholders in the order they appear in the sql
+    ordered_values = []
+
+    def replace(match) -> str:
+        ordered_values.append(values[int(match.group(1))])
+        return paramstyles[paramstyle].format(i=len(ordered_values))
+
+    sql = re.sub(parameter_marker_pattern, replace, sql)
+    if canonical:
+        # the fingerprint should not depend on the numbering of the markers
+        sql = add_fingerprint(sql.split(' */ ', 1)[1])
+
+    if paramstyle in ('named', 'pyformat'):
+        return sql, {f"p{i + 1}": value for i, value in enumerate(ordered_values)}
+    return sql, ordered_values
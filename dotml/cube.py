@@ -17,3 +17,14 @@ def load_cube_configs(dir_path: str = "cubes") -> List[Dict]:
             cube_config = load_cubes(os.path.join(dir_path, file))
             cube_configs.append(cube_config)
     return cube_configs
+
+
+def load_model(model_id: str, dir_path: str = "cubes") -> Dict:
+    """load the cubes of one model, stored as <model_id>.yaml in dir_path"""
+    # model ids can come from tenants, they must not point outside of dir_path
+    if model_id != os.path.basename(model_id) or model_id in ('', '.', '..'):
+        raise ValueError(f"Invalid model id '{model_id}'.")
+    file_path = os.path.join(dir_path, model_id + ".yaml")
+    if not os.path.isfile(file_path):
+        raise ValueError(f"Model '{model_id}' not found in {dir_path}.")
+    return load_cubes(file_path)
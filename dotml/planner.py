@@ -0,0 +1,447 @@
+import re
+from abc import ABC, abstractmethod
+from collections import ChainMap
+from typing import Dict, List, Optional, Tuple
+
+from dotml.compiler import SubstitutedVariables, join_query, prepare_cube, substitute_variables, variable_pattern
+
+# row count that is assumed for cubes without a 'rows' hint
+default_cube_rows = 1000000
+
+# offset used to make the primary key part of symmetric aggregates, metric values must stay below it
+symmetric_aggregate_offset = 1000000000
+
+aggregate_pattern = re.compile(r"^\s*(sum|count|min|max|avg)\s*\((.*)\)\s*$", re.IGNORECASE | re.DOTALL)
+equality_pattern = re.compile(r"^\s*([^=<>!]+?)\s*=\s*([^=<>!]+?)\s*$")
+
+# how the metrics of a pre aggregated cube are combined again after the join
+re_aggregations = {'sum': 'sum', 'count': 'sum', 'min': 'min', 'max': 'max'}
+
+
+def split_aggregate(sql: str) -> Optional[Tuple[str, str]]:
+    """split a metric like sum(x) into its aggregate function and argument, None for other expressions"""
+    match = re.match(aggregate_pattern, sql)
+    if match is None:
+        return None
+    argument = match.group(2)
+    # sum(a) - sum(b) also matches the pattern, the parentheses of the argument must be balanced
+    depth = 0
+    for char in argument:
+        depth += 1 if char == '(' else -1 if char == ')' else 0
+        if depth < 0:
+            return None
+    if depth != 0:
+        return None
+    return match.group(1).lower(), argument.strip()
+
+
+def split_join_condition(on_sql: str) -> Optional[List[Tuple[str, str]]]:
+    """split a join condition like a.x = b.y and a.z = b.w into pairs, None if it is not only equalities"""
+    pairs = []
+    for part in re.split(r"\s+and\s+", on_sql, flags=re.IGNORECASE):
+        match = re.match(equality_pattern, part)
+        if match is None:
+            return None
+        pairs.append((match.group(1), match.group(2)))
+    return pairs
+
+
+def references(sql: str, alias: str) -> bool:
+    return re.search(rf"(?<![\w.]){re.escape(alias)}\.", sql) is not None
+
+
+def get_cube_rows(cube: Dict) -> int:
+    return cube.get('rows', default_cube_rows)
+
+
+def get_join_on_sql(join: Dict, cubes_by_name: Dict) -> str:
+    join_vars = {name: cube.get('alias') for name, cube in cubes_by_name.items()}
+    return substitute_variables(join.get('on_sql'), join_vars, recursive=False)
+
+
+def get_join_relationship(join: Dict, cubes_by_name: Dict) -> str:
+    """relationship of the left to the right cube, taken from the join or inferred from the primary keys"""
+    if join.get('relationship') is not None:
+        return join['relationship']
+
+    on_sql = get_join_on_sql(join, cubes_by_name)
+
+    def joins_on_primary_key(cube: Dict) -> bool:
+        pk_sql = [substitute_variables(pk.get('sql'), cube.get('cube_vars')) for pk in cube['pk']]
+        return all(re.search(rf"(?<![\w.]){re.escape(pk)}(?!\w)", on_sql) for pk in pk_sql)
+
+    left_is_one = joins_on_primary_key(cubes_by_name[join['left']])
+    right_is_one = joins_on_primary_key(cubes_by_name[join['right']])
+    if left_is_one and right_is_one:
+        return 'one_to_one'
+    elif left_is_one:
+        return 'one_to_many'
+    elif right_is_one:
+        return 'many_to_one'
+    return 'many_to_many'
+
+
+def reverse_join(join: Dict) -> Dict:
+    """the same join seen from the right cube"""
+    flip_type = {'left': 'right', 'right': 'left'}
+    flip_relationship = {'one_to_many': 'many_to_one', 'many_to_one': 'one_to_many'}
+    return {**join,
+            'left': join['right'],
+            'right': join['left'],
+            'type': flip_type.get(join.get('type'), join.get('type')),
+            'relationship': flip_relationship.get(join['relationship'], join['relationship'])}
+
+
+def get_cube_joins(plan: Dict, cube_name: str) -> List[Dict]:
+    """all joins of the plan that touch a cube, seen from that cube"""
+    cube_joins = []
+    for join in plan['joins']:
+        if join['left'] == cube_name:
+            cube_joins.append(join)
+        elif join['right'] == cube_name:
+            cube_joins.append(reverse_join(join))
+    return cube_joins
+
+
+def get_queried_fields(cube: Dict, all_query_fields: List[str]) -> Dict:
+    """queried fields of a cube in query order, with compiled sql"""
+    queried_fields = {}
+    for query_field in all_query_fields:
+        cube_name, field_name = query_field.split('.')
+        if cube_name == cube.get('name') and field_name in cube['cube_fields']:
+            cube_field = cube['cube_fields'][field_name]
+            if not cube_field.get('window'):  # todo add window functions
+                queried_fields[field_name] = {**cube_field,
+                                              'sql': substitute_variables(cube_field['sql'], cube.get('cube_vars'))}
+    return queried_fields
+
+
+def compile_filter(fil: str, variables: Dict) -> str:
+    # ${orders.country_id} becomes ${orders__country_id}, which is part of the cube variables
+    fil = re.sub(variable_pattern, lambda m: '${' + m.group(1).replace('.', '__') + '}', fil)
+    return f"({substitute_variables(fil, variables)})"
+
+
+def compile_order_and_limit(sorts: List[str], limit: Optional[int]) -> List[str]:
+    lines = []
+    if sorts:
+        # fields are selected by name, so they can be sorted by name
+        lines.append('order by ' + ', '.join([sort.split('.')[1] for sort in sorts]))
+    if limit:
+        lines.append(f"limit {limit}")
+    return lines
+
+
+class FanOutStrategy(ABC):
+    """
+    a way to aggregate metrics of several joined cubes without counting rows twice (fan out)
+
+    strategies are registered with register_fan_out_strategy, the planner picks the applicable one with the
+    lowest estimated cost
+    strategies with opt_in are only used when a query asks for them with fan_out_strategy
+    a strategy that does not implement all methods can not be instantiated, so it fails before it is registered
+    """
+    name = ''
+    opt_in = False
+
+    @abstractmethod
+    def is_applicable(self, plan: Dict) -> bool:
+        ...
+
+    @abstractmethod
+    def estimate_cost(self, plan: Dict) -> float:
+        ...
+
+    @abstractmethod
+    def compile(self, plan: Dict) -> str:
+        ...
+
+
+class DimensionCteStrategy(FanOutStrategy):
+    """
+    a dimension cte on primary key grain and a metrics cte per cube, joined on all queried dimensions
+    works for every join, but scans each cube and its join partners twice
+    """
+    name = 'dimension_cte'
+
+    def is_applicable(self, plan: Dict) -> bool:
+        return True
+
+    def estimate_cost(self, plan: Dict) -> float:
+        all_rows = sum([get_cube_rows(cube) for cube in plan['cubes']])
+        return 3 * all_rows + (len(plan['cubes']) - 1) * all_rows
+
+    def compile(self, plan: Dict) -> str:
+        # join_query annotates the cubes, so it gets its own copies
+        cubes = [{**cube} for cube in plan['cubes']]
+        return join_query(cubes, plan['all_joins'], plan['fields'], plan['filters'], plan['sorts'], plan['limit'],
+                          plan['all_query_fields'])
+
+
+class PreAggregateStrategy(FanOutStrategy):
+    """
+    aggregate each child cube by its join key first and join the result to the parent cube
+    only applies if all queried dimensions belong to the parent, the parent is the 'one' side of all joins and
+    the child metrics can be aggregated again (sum, count, min, max)
+    """
+    name = 'pre_aggregate'
+
+    def get_root(self, plan: Dict) -> Optional[Tuple[Dict, List[Dict]]]:
+        """find the parent cube and the join information of its children"""
+        dimension_cubes = set([cube['name'] for cube in plan['prepared_cubes']
+                               for f in get_queried_fields(cube, plan['all_query_fields']).values() if f.get('dim')])
+        if len(dimension_cubes) > 1:
+            return None
+
+        for root in plan['prepared_cubes']:
+            if len(dimension_cubes) == 1 and root['name'] not in dimension_cubes:
+                continue
+            children = []
+            for cube in plan['prepared_cubes']:
+                if cube is root:
+                    continue
+                child = self.get_child(plan, root, cube)
+                if child is None:
+                    break
+                children.append(child)
+            else:
+                return root, children
+        return None
+
+    @staticmethod
+    def get_child(plan: Dict, root: Dict, cube: Dict) -> Optional[Dict]:
+        for join in get_cube_joins(plan, root['name']):
+            if join['right'] != cube['name']:
+                continue
+            # unmatched rows of the child could not be attributed to any dimension of the root
+            if join['relationship'] not in ('one_to_many', 'one_to_one') or join.get('type') not in ('left', 'inner'):
+                return None
+            pairs = split_join_condition(join['on_sql'])
+            if pairs is None:
+                return None
+            # orient each equality as root expression = child expression
+            key_pairs = []
+            for a, b in pairs:
+                if references(a, root['alias']) and references(b, cube['alias']):
+                    key_pairs.append((a, b))
+                elif references(b, root['alias']) and references(a, cube['alias']):
+                    key_pairs.append((b, a))
+                else:
+                    return None
+            metrics = list(get_queried_fields(cube, plan['all_query_fields']).values())
+            for metric in metrics:
+                aggregate = split_aggregate(metric['sql'])
+                if aggregate is None or aggregate[0] not in re_aggregations or 'distinct' in aggregate[1].lower():
+                    return None
+            return {'cube': cube, 'join_type': join.get('type'), 'key_pairs': key_pairs, 'metrics': metrics}
+        return None
+
+    def is_applicable(self, plan: Dict) -> bool:
+        return self.get_root(plan) is not None
+
+    def estimate_cost(self, plan: Dict) -> float:
+        root, _ = self.get_root(plan)
+        return sum([get_cube_rows(cube) for cube in plan['cubes']]) + get_cube_rows(root)
+
+    def compile(self, plan: Dict) -> str:
+        root, children = self.get_root(plan)
+
+        ctes = []
+        join_exprs = []
+        child_select_fields = []
+        for child in children:
+            cube = child['cube']
+            pre_alias = f"{cube['alias']}_pre_aggregate"
+            key_cols = [f"{child_expr} as key{i}" for i, (_, child_expr) in enumerate(child['key_pairs'])]
+            metric_cols = [f"{m.get('sql')} as {m.get('name')}" for m in child['metrics']]
+            select_expr = ',\n'.join(key_cols + metric_cols)
+            group_expr = ', '.join([str(i + 1) for i, _ in enumerate(key_cols)])
+            where_expr = ''
+            if len(cube['always_where_conditions']) > 0:
+                where_expr = 'where ' + ' and '.join(cube['always_where_conditions'])
+            ctes.append(f"""{pre_alias} as (
+select  {select_expr}
+from {cube['table']} as {cube['alias']}
+{where_expr}
+group by {group_expr}
+)""")
+
+            on_sql = ' and '.join(
+                [f"{root_expr} = {pre_alias}.key{i}" for i, (root_expr, _) in enumerate(child['key_pairs'])])
+            join_exprs.append(f"{child['join_type']} join {pre_alias}\n    on {on_sql}")
+            child_select_fields.extend(
+                [f"{re_aggregations[split_aggregate(m['sql'])[0]]}({pre_alias}.{m['name']}) as {m['name']}"
+                 for m in child['metrics']])
+
+        root_fields = list(get_queried_fields(root, plan['all_query_fields']).values())
+        select_expr = ', '.join([f"{f.get('sql')} as {f.get('name')}" for f in root_fields] + child_select_fields)
+
+        where_conditions = root['always_where_conditions'] + [compile_filter(f, root['cube_vars'])
+                                                              for f in plan['filters']]
+
+        lines = [f"with {', '.join(ctes)}" if ctes else '',
+                 f"select {select_expr}",
+                 f"from {root['table']} as {root['alias']}"] + join_exprs
+        if where_conditions:
+            lines.append('where ' + ' and '.join(where_conditions))
+        dim_positions = [str(i + 1) for i, f in enumerate(root_fields) if f.get('dim')]
+        if dim_positions:
+            lines.append('group by ' + ', '.join(dim_positions))
+        lines.extend(compile_order_and_limit(plan['sorts'], plan['limit']))
+        return '\n'.join([line for line in lines if line != ''])
+
+
+class SymmetricAggregateStrategy(FanOutStrategy):
+    """
+    join all cubes directly and make every metric ignore duplicated rows with its primary key,
+    e.g. sum(x) becomes sum(distinct pk * offset + x) - sum(distinct pk * offset)
+    only applies if the primary keys are numeric (type: number) and metrics are sum, count, min, max or avg
+
+    opt in only: the result is exact only while pk * offset + value fits the numeric type of the database,
+    e.g. 2^53 for doubles, larger keys or fractional values silently lose precision
+    """
+    name = 'symmetric_aggregate'
+    opt_in = True
+
+    @staticmethod
+    def get_join_order(plan: Dict) -> Optional[List[Tuple[Dict, Dict]]]:
+        """joins to add to the first cube, one per other cube, None if the cubes are not connected"""
+        cubes_by_name = {cube['name']: cube for cube in plan['prepared_cubes']}
+        joined = [plan['prepared_cubes'][0]['name']]
+        join_order = []
+        found = True
+        while found and len(joined) < len(cubes_by_name):
+            found = False
+            for cube_name in list(joined):
+                for join in get_cube_joins(plan, cube_name):
+                    if join['right'] not in joined:
+                        joined.append(join['right'])
+                        join_order.append((cubes_by_name[join['right']], join))
+                        found = True
+        if len(joined) < len(cubes_by_name):
+            return None
+        return join_order
+
+    @staticmethod
+    def get_symmetric_metric(metric: Dict, cube: Dict) -> Optional[str]:
+        if metric.get('dim'):
+            return metric['sql']
+        aggregate = split_aggregate(metric['sql'])
+        if aggregate is None:
+            return None
+        function, argument = aggregate
+        if function in ('min', 'max') or argument.lower().startswith('distinct '):
+            # not affected by duplicated rows
+            return metric['sql']
+
+        pk = substitute_variables(cube['pk'][0].get('sql'), cube.get('cube_vars'))
+        offset = symmetric_aggregate_offset
+        distinct_count = f"count(distinct {pk})" if argument == '*' else \
+            f"count(distinct case when {argument} is not null then {pk} end)"
+        distinct_sum = f"(sum(distinct {pk} * {offset} + {argument}) - " \
+                       f"sum(distinct case when {argument} is not null then {pk} * {offset} end))"
+        if function == 'count':
+            return distinct_count
+        elif function == 'sum':
+            return distinct_sum
+        return f"{distinct_sum} * 1.0 / {distinct_count}"  # avg
+
+    def is_applicable(self, plan: Dict) -> bool:
+        if self.get_join_order(plan) is None:
+            return False
+        for cube in plan['prepared_cubes']:
+            metrics = [f for f in get_queried_fields(cube, plan['all_query_fields']).values() if not f.get('dim')]
+            if len(metrics) == 0:
+                continue
+            if len(cube['pk']) != 1 or cube['pk'][0].get('type') != 'number':
+                return False
+            if any([self.get_symmetric_metric(m, cube) is None for m in metrics]):
+                return False
+        return True
+
+    def estimate_cost(self, plan: Dict) -> float:
+        # the joined rows have the grain of the largest cube and distinct aggregation is expensive
+        rows = [get_cube_rows(cube) for cube in plan['cubes']]
+        return sum(rows) + 2 * max(rows)
+
+    def compile(self, plan: Dict) -> str:
+        root = plan['prepared_cubes'][0]
+        join_exprs = []
+        for cube, join in self.get_join_order(plan):
+            # always filters of joined cubes go into the join condition, so left joins stay left joins
+            on_sql = ' and '.join([join['on_sql']] + cube['always_where_conditions'])
+            join_exprs.append(f"{join.get('type')} join {cube['table']} as {cube['alias']}\n    on {on_sql}")
+
+        select_fields = []
+        for cube in plan['prepared_cubes']:
+            for f in get_queried_fields(cube, plan['all_query_fields']).values():
+                select_fields.append({**f, 'sql': self.get_symmetric_metric(f, cube)})
+        select_expr = ', '.join([f"{f.get('sql')} as {f.get('name')}" for f in select_fields])
+
+        # filters can reference fields of all cubes
+        filter_vars = ChainMap(*[SubstitutedVariables(cube.get('cube_vars')) for cube in plan['prepared_cubes']])
+        where_conditions = root['always_where_conditions'] + [compile_filter(f, filter_vars) for f in plan['filters']]
+
+        lines = [f"select {select_expr}",
+                 f"from {root['table']} as {root['alias']}"] + join_exprs
+        if where_conditions:
+            lines.append('where ' + ' and '.join(where_conditions))
+        dim_positions = [str(i + 1) for i, f in enumerate(select_fields) if f.get('dim')]
+        if dim_positions:
+            lines.append('group by ' + ', '.join(dim_positions))
+        lines.extend(compile_order_and_limit(plan['sorts'], plan['limit']))
+        return '\n'.join(lines)
+
+
+fan_out_strategies: Dict[str, FanOutStrategy] = {}
+
+
+def register_fan_out_strategy(strategy: FanOutStrategy) -> FanOutStrategy:
+    fan_out_strategies[strategy.name] = strategy
+    return strategy
+
+
+register_fan_out_strategy(DimensionCteStrategy())
+register_fan_out_strategy(PreAggregateStrategy())
+register_fan_out_strategy(SymmetricAggregateStrategy())
+
+
+def get_fan_out_plan(cubes: List[Dict], joins: List[Dict], fields: List[str], filters: List[str], sorts: List[str],
+                     limit: Optional[int], all_query_fields: List[str]) -> Dict:
+    """collect everything the strategies need to judge and compile a multi cube query"""
+    other_table_aliases = []
+    prepared_cubes = [prepare_cube({**cube}, other_table_aliases) for cube in cubes]
+    cubes_by_name = {cube['name']: cube for cube in prepared_cubes}
+
+    plan_joins = []
+    for join in joins:
+        if join['left'] in cubes_by_name and join['right'] in cubes_by_name:
+            plan_joins.append({**join,
+                               'on_sql': get_join_on_sql(join, cubes_by_name),
+                               'relationship': get_join_relationship(join, cubes_by_name)})
+
+    return {'cubes': cubes, 'prepared_cubes': prepared_cubes, 'all_joins': joins, 'joins': plan_joins,
+            'fields': fields, 'filters': filters, 'sorts': sorts, 'limit': limit,
+            'all_query_fields': all_query_fields}
+
+
+def choose_fan_out_strategy(plan: Dict, strategy_name: Optional[str] = None) -> FanOutStrategy:
+    """the requested strategy, otherwise the applicable strategy (not opt in) with the lowest estimated cost"""
+    if strategy_name is not None:
+        if strategy_name not in fan_out_strategies:
+            raise ValueError(f"Fan-out strategy '{strategy_name}' does not exist.")
+        strategy = fan_out_strategies[strategy_name]
+        if not strategy.is_applicable(plan):
+            raise ValueError(f"Fan-out strategy '{strategy_name}' can not be used for this query.")
+        return strategy
+
+    applicable = [s for s in fan_out_strategies.values() if not s.opt_in and s.is_applicable(plan)]
+    return min(applicable, key=lambda s: s.estimate_cost(plan))
+
+
+def plan_join_query(cubes: List[Dict], joins: List[Dict], fields: List[str], filters: List[str], sorts: List[str],
+                    limit: Optional[int], all_query_fields: List[str], strategy_name: Optional[str] = None) -> str:
+    plan = get_fan_out_plan(cubes, joins, fields, filters, sorts, limit, all_query_fields)
+    strategy = choose_fan_out_strategy(plan, strategy_name)
+    # make the choice visible in the sql
+    return f"/* dotml fan-out strategy: {strategy.name} */\n{strategy.compile(plan)}"
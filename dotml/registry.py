@@ -0,0 +1,124 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import partial
+from typing import Callable, Dict, Optional
+
+from dotml.compiler import generate_sql_query, get_compiled_cube_fields
+from dotml.cube import load_model
+
+# memory budget of all compiled models in a registry
+default_max_bytes = 256 * 1024 * 1024
+
+
+def get_size(obj) -> int:
+    """approximate memory size of nested dicts, lists and values in bytes"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum([get_size(k) + get_size(v) for k, v in obj.items()])
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum([get_size(v) for v in obj])
+    return size
+
+
+class CompiledModel:
+    """cubes config of a model with the compiled fields of all its cubes, which every query of the model reuses"""
+
+    def __init__(self, model_id: str, cubes_config: Dict, used_at: float):
+        self.model_id = model_id
+        self.cubes_config = cubes_config
+        self.cube_fields = {cube['name']: get_compiled_cube_fields(cube) for cube in cubes_config.get('cubes', [])}
+        self.config_size = get_size(cubes_config)
+        self.fields_size = 0
+        self.resolved_count = -1
+        self.used_at = used_at
+
+    @property
+    def size(self) -> int:
+        # variants are resolved on demand, so only the resolved ones take memory, measured again when they change
+        resolved_count = sum([len(f.resolved) for f in self.cube_fields.values()])
+        if resolved_count != self.resolved_count:
+            self.resolved_count = resolved_count
+            self.fields_size = sum([get_size(f.fields) + get_size(f.resolved) for f in self.cube_fields.values()])
+        return self.config_size + self.fields_size
+
+    def generate_sql_query(self, query: Dict, **kwargs) -> str:
+        return generate_sql_query(self.cubes_config, query, cube_fields=self.cube_fields, **kwargs)
+
+
+class ModelRegistry:
+    """
+    models by model (or tenant) id, loaded and compiled on first use
+
+    loader returns the cubes config of a model id, by default <model_id>.yaml in dir_path. If the compiled models
+    exceed max_bytes, the least recently used are evicted, as well as models that were not used for
+    max_idle_seconds. Concurrent first uses of a model wait for a single load.
+    """
+
+    def __init__(self, loader: Optional[Callable[[str], Dict]] = None, dir_path: str = "cubes",
+                 max_bytes: int = default_max_bytes, max_idle_seconds: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.loader = loader if loader is not None else partial(load_model, dir_path=dir_path)
+        self.max_bytes = max_bytes
+        self.max_idle_seconds = max_idle_seconds
+        self.clock = clock
+        self.models: 'OrderedDict[str, CompiledModel]' = OrderedDict()
+        self.loading: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return sum([model.size for model in self.models.values()])
+
+    def get(self, model_id: str) -> CompiledModel:
+        with self.lock:
+            model = self.models.get(model_id)
+            if model is not None:
+                model.used_at = self.clock()
+                self.models.move_to_end(model_id)
+                self.evict()
+                return model
+            future = self.loading.get(model_id)
+            is_loading = future is not None
+            if not is_loading:
+                future = Future()
+                self.loading[model_id] = future
+
+        if is_loading:
+            # another thread loads this model already
+            return future.result()
+
+        try:
+            model = CompiledModel(model_id, self.loader(model_id), self.clock())
+        except Exception as e:
+            with self.lock:
+                del self.loading[model_id]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.models[model_id] = model
+            del self.loading[model_id]
+            self.evict()
+        future.set_result(model)
+        return model
+
+    def evict(self) -> None:
+        """drop idle models and the least recently used models above the memory budget, needs the lock"""
+        if self.max_idle_seconds is not None:
+            now = self.clock()
+            for model_id in [m.model_id for m in self.models.values() if now - m.used_at > self.max_idle_seconds]:
+                del self.models[model_id]
+        # the most recently used model is kept, even if it exceeds the budget alone
+        while len(self.models) > 1 and self.size > self.max_bytes:
+            self.models.popitem(last=False)
+
+    def remove(self, model_id: str) -> None:
+        """drop a model, e.g. after its cubes changed, it is loaded again on next use"""
+        with self.lock:
+            self.models.pop(model_id, None)
+
+    def generate_sql_query(self, model_id: str, query: Dict, **kwargs) -> str:
+        return self.get(model_id).generate_sql_query(query, **kwargs)
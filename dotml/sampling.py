@@ -0,0 +1,178 @@
+from typing import Dict, List, Optional, Union
+
+from dotml.compiler import get_simple_variables, get_cube_fields, substitute_variables
+from dotml.planner import default_cube_rows, split_aggregate, split_join_condition
+
+# sampling clauses per dialect, tablesample is None if the dialect has none
+# hash turns a key into an integer, so rows can be sampled deterministically by their key, modulo buckets it
+sample_dialects = {
+    'snowflake': {'tablesample': 'sample bernoulli ({percent})', 'hash': 'hash({expr})',
+                  'modulo': '{expr} % {buckets}'},
+    'bigquery': {'tablesample': 'tablesample system ({percent} percent)',
+                 'hash': 'farm_fingerprint(cast({expr} as string))', 'modulo': 'mod({expr}, {buckets})'},
+    'postgres': {'tablesample': 'tablesample bernoulli ({percent})', 'hash': 'hashtext(cast({expr} as text))',
+                 'modulo': '{expr} % {buckets}'},
+    'duckdb': {'tablesample': 'using sample {percent} percent (bernoulli)', 'hash': 'hash({expr})',
+               'modulo': '{expr} % {buckets}'},
+    # sqlite: multiplicative hash, only works for numeric keys, a text key is 0 and every row would be sampled
+    'sqlite': {'tablesample': None, 'hash': '({expr} * 2654435761)', 'modulo': '{expr} % {buckets}',
+               'numeric_keys': True},
+}
+
+# number of buckets of the hash based sample, a sample rate is a number of buckets
+sample_buckets = 10000
+
+
+def get_sample_percent(sample: Union[int, float, str, Dict], cubes: List[Dict]) -> float:
+    """
+    read the sample option of a query, e.g. 10, '10%', {'percent': 10} or {'rows': 10000}
+    a row budget is converted to a percentage of the largest cube, based on the 'rows' hint
+    """
+    if isinstance(sample, dict):
+        if sample.get('percent') is not None:
+            percent = float(sample['percent'])
+        elif sample.get('rows') is not None:
+            largest_cube_rows = max([cube.get('rows', default_cube_rows) for cube in cubes])
+            percent = min(100.0, float(sample['rows']) / largest_cube_rows * 100)
+        else:
+            raise ValueError(f"Sample {sample} needs a 'percent' or 'rows' key.")
+    elif isinstance(sample, str):
+        percent = float(sample.strip().rstrip('%'))
+    else:
+        percent = float(sample)
+
+    if percent <= 0 or percent > 100:
+        raise ValueError(f"Sample percentage must be between 0 and 100, got {percent}.")
+    return percent
+
+
+def get_hash_sample_sql(table: str, inner_alias: str, key_expr: str, percent: float, dialect: Dict) -> str:
+    hash_expr = dialect['hash'].format(expr=key_expr)
+    bucket_expr = dialect['modulo'].format(expr=hash_expr, buckets=sample_buckets)
+    threshold = round(percent / 100 * sample_buckets)
+    return f"(select * from {table} as {inner_alias} where abs({bucket_expr}) < {threshold})"
+
+
+def get_key_expr(cube: Dict, sql: str) -> str:
+    """resolve ${table} and field references of a cube in sql that runs inside the sample subquery"""
+    cube_fields = cube.get('cube_fields')
+    variables = get_simple_variables(cube['name'], cube['name'],
+                                     cube_fields if cube_fields is not None else get_cube_fields(cube))
+    return substitute_variables(sql, variables)
+
+
+def has_numeric_primary_key(cube: Dict) -> bool:
+    pk = [f for f in cube.get('dimensions', []) if f.get('primary_key', False)]
+    return len(pk) == 1 and pk[0].get('type') == 'number'
+
+
+def get_sample_keys(root: Dict, cubes: List[Dict], joins: List[Dict]) -> Dict[str, str]:
+    """
+    sample key of each cube that can be sampled consistently with the root cube
+
+    the root is sampled on its primary key, joined cubes on the column that equals the key of their join partner,
+    so an order and all its order items are either in the sample or not
+    """
+    pk = [f for f in root.get('dimensions', []) if f.get('primary_key', False)]
+    if len(pk) != 1:
+        return {}
+    sample_keys = {root['name']: get_key_expr(root, pk[0]['sql'])}
+    cubes_by_name = {cube['name']: cube for cube in cubes}
+
+    found = True
+    while found:
+        found = False
+        for join in joins:
+            if join['left'] not in cubes_by_name or join['right'] not in cubes_by_name:
+                continue
+            # the expressions of the sample subqueries use the cube name as alias
+            on_sql = substitute_variables(join['on_sql'], {name: name for name in cubes_by_name}, recursive=False)
+            pairs = split_join_condition(on_sql) or []
+            for a, b in pairs + [(b, a) for a, b in pairs]:
+                for sampled, other in ((join['left'], join['right']), (join['right'], join['left'])):
+                    if sampled in sample_keys and other not in sample_keys and a == sample_keys[sampled] \
+                            and b.startswith(other + '.'):
+                        sample_keys[other] = b
+                        found = True
+    return sample_keys
+
+
+def scale_metric(sql: str, factor: float) -> str:
+    """scale additive metrics (sum, count) to the full data, other metrics are returned unchanged"""
+    aggregate = split_aggregate(sql)
+    if aggregate is None or aggregate[1].lower().startswith('distinct '):
+        return sql
+    function, argument = aggregate
+    # keep the sum(...) form, so the planner can still aggregate the metric again
+    if function == 'sum':
+        return f"sum({argument} * {factor})"
+    elif function == 'count':
+        if argument == '*':
+            return f"sum({factor})"
+        return f"sum(case when {argument} is not null then {factor} else 0 end)"
+    return sql
+
+
+def sample_cubes(cubes: List[Dict], joins: List[Dict], needed_cubes: List[str], sample: Union[int, float, str, Dict],
+                 dialect_name: Optional[str] = None) -> List[Dict]:
+    """
+    replace the tables of the needed cubes with sampled subqueries
+
+    a single cube is read through the sampling clause of the dialect, joined cubes through a hash of their
+    primary or join key, which keeps joins (and fan-out) consistent. Cubes that can not be sampled consistently
+    are read completely, a ValueError is raised if no cube can be sampled or the dialect is unknown.
+    With {'scale': true} additive metrics are scaled up by the sample rate.
+    """
+    query_cubes = [cube for cube in cubes if cube.get('name') in needed_cubes]
+    percent = get_sample_percent(sample, query_cubes)
+    if percent >= 100:
+        return cubes
+    if dialect_name not in sample_dialects:
+        raise ValueError(f"Sampling needs a known 'dialect' in the cubes, one of {', '.join(sample_dialects)}, "
+                         f"got {dialect_name}.")
+    dialect = sample_dialects[dialect_name]
+
+    sample_keys = {}
+    if len(query_cubes) == 1 and dialect['tablesample'] is not None:
+        cube = query_cubes[0]
+        tablesample = dialect['tablesample'].format(percent=f"{percent:g}")
+        sample_tables = {cube['name']: f"(select * from {cube['table']} {tablesample})"}
+    else:
+        # sample with the root cube that keeps most cubes consistent
+        # joined cubes are sampled on columns equal to the key of the root, so they are numeric if the root key is
+        roots = query_cubes
+        if dialect.get('numeric_keys'):
+            roots = [cube for cube in query_cubes if has_numeric_primary_key(cube)]
+            if len(roots) == 0:
+                raise ValueError(f"Sampling on {dialect_name} needs a numeric primary key (type: number) in one of "
+                                 f"the cubes: {', '.join([cube['name'] for cube in query_cubes])}.")
+        for root in roots:
+            root_sample_keys = get_sample_keys(root, query_cubes, joins)
+            if len(root_sample_keys) > len(sample_keys):
+                sample_keys = root_sample_keys
+        sample_tables = {}
+        for cube in query_cubes:
+            if cube['name'] in sample_keys:
+                sample_tables[cube['name']] = get_hash_sample_sql(cube['table'], cube['name'],
+                                                                  sample_keys[cube['name']], percent, dialect)
+        if len(sample_tables) == 0:
+            raise ValueError(f"The query can not be sampled, cubes need a single primary key: "
+                             f"{', '.join([cube['name'] for cube in query_cubes])}.")
+        # log a warning if a cube is read completely
+        if len(sample_tables) < len(query_cubes):
+            print(f"Cubes {', '.join([c['name'] for c in query_cubes if c['name'] not in sample_tables])} "
+                  f"can not be sampled consistently and are read completely.")
+
+    scale = isinstance(sample, dict) and sample.get('scale', False)
+    factor = round(100 / percent, 6)
+
+    sampled_cubes = []
+    for cube in cubes:
+        if cube.get('name') in sample_tables:
+            cube = {**cube, 'table': sample_tables[cube['name']]}
+            if scale:
+                cube['metrics'] = [{**m, 'sql': scale_metric(m['sql'], factor)} for m in cube.get('metrics', [])]
+                # the fields are compiled again from the scaled metrics
+                cube['cube_fields'] = None
+        sampled_cubes.append(cube)
+    return sampled_cubes
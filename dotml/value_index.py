@@ -0,0 +1,145 @@
+import sys
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dotml.compiler import generate_sql_query
+
+# values of a dimension are refreshed after this many seconds, unless the dimension sets index: {refresh: ...}
+default_refresh_seconds = 3600
+
+# maximum number of distinct values that are fetched for a dimension
+default_max_values = 10000
+
+# memory budget of all values in an index
+default_max_bytes = 64 * 1024 * 1024
+
+
+def get_indexed_dimensions(cubes_config: Dict) -> List[str]:
+    """all dimensions flagged with index in the cube yaml, as cube.dimension"""
+    indexed_dimensions = []
+    for cube in cubes_config.get('cubes', []):
+        for dimension in cube.get('dimensions', []):
+            if dimension.get('index'):
+                indexed_dimensions.append(f"{cube['name']}.{dimension['name']}")
+    return indexed_dimensions
+
+
+def get_dimension_values_query(cubes_config: Dict, field: str, max_values: int = default_max_values) -> str:
+    """sql for the distinct values of a dimension, the always_filter of its cube applies"""
+    cube_name = field.split('.')[0]
+    # only the cube of the dimension is needed, so no joins are involved
+    cube_config = {**cubes_config, 'cubes': [c for c in cubes_config.get('cubes', []) if c.get('name') == cube_name]}
+    return generate_sql_query(cube_config, {'fields': [field], 'sorts': [field], 'limit': max_values})
+
+
+def get_value_sort_key(value) -> Tuple:
+    # numbers in numeric order, other values as case insensitive text after them
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return 0, value, ''
+    return 1, str(value).casefold(), str(value)
+
+
+class DimensionValues:
+    """
+    values of one dimension in their original type and order, truncated if max_values was hit
+
+    the prefix search is case insensitive on the text of the values, matches are returned in value order
+    """
+
+    def __init__(self, values: List, loaded_at: float, truncated: bool = False):
+        self.values: Tuple = tuple(sorted(set([v for v in values if v is not None]), key=get_value_sort_key))
+        # search keys sorted as text, with the position of their value
+        pairs = sorted([(str(v).casefold(), i) for i, v in enumerate(self.values)])
+        self.keys: Tuple[str, ...] = tuple([k for k, _ in pairs])
+        self.positions: Tuple[int, ...] = tuple([i for _, i in pairs])
+        self.loaded_at = loaded_at
+        self.truncated = truncated
+        self.size = sys.getsizeof(self.keys) + sys.getsizeof(self.values) + sys.getsizeof(self.positions) + \
+            sum([sys.getsizeof(k) for k in self.keys]) + sum([sys.getsizeof(v) for v in self.values])
+
+    def search(self, prefix: str = '', limit: Optional[int] = None) -> List:
+        prefix = prefix.casefold()
+        if prefix == '':
+            return list(self.values[:limit])
+        start = end = bisect_left(self.keys, prefix)
+        while end < len(self.keys) and self.keys[end].startswith(prefix):
+            end += 1
+        return [self.values[i] for i in sorted(self.positions[start:end])[:limit]]
+
+
+class DimensionValueIndex:
+    """
+    in memory index of distinct dimension values, e.g. for filter pickers
+
+    values are loaded with execute, a function that runs sql and returns rows, and reloaded after the refresh
+    interval. If the values of all dimensions exceed max_bytes, the least recently used dimensions are dropped.
+    """
+
+    def __init__(self, cubes_config: Dict, execute: Callable[[str], List[Tuple]],
+                 refresh_seconds: float = default_refresh_seconds, max_bytes: int = default_max_bytes,
+                 max_values: int = default_max_values, clock: Callable[[], float] = time.monotonic):
+        self.cubes_config = cubes_config
+        self.execute = execute
+        self.refresh_seconds = refresh_seconds
+        self.max_bytes = max_bytes
+        self.max_values = max_values
+        self.clock = clock
+        self.entries: 'OrderedDict[str, DimensionValues]' = OrderedDict()
+
+    @property
+    def size(self) -> int:
+        return sum([entry.size for entry in self.entries.values()])
+
+    def get_refresh_seconds(self, field: str) -> float:
+        cube_name, dimension_name = field.split('.')
+        for cube in self.cubes_config.get('cubes', []):
+            if cube.get('name') == cube_name:
+                for dimension in cube.get('dimensions', []):
+                    if dimension.get('name') == dimension_name:
+                        if not dimension.get('index'):
+                            raise ValueError(f"Dimension '{field}' is not indexed.")
+                        if isinstance(dimension['index'], dict):
+                            return dimension['index'].get('refresh', self.refresh_seconds)
+                        return self.refresh_seconds
+        raise ValueError(f"Dimension '{field}' does not exist in the cubes.")
+
+    def get_values_query(self, field: str) -> str:
+        """sql that loads the values of a dimension, one more value than kept tells if the dimension has more"""
+        return get_dimension_values_query(self.cubes_config, field, self.max_values + 1)
+
+    def refresh(self, field: Optional[str] = None) -> Dict[str, DimensionValues]:
+        """reload the values of one or all indexed dimensions, also returns values too large to keep"""
+        fields = [field] if field is not None else get_indexed_dimensions(self.cubes_config)
+        loaded = {}
+        for f in fields:
+            self.get_refresh_seconds(f)  # validate the field
+            rows = self.execute(self.get_values_query(f))
+            if len(rows) > self.max_values:
+                print(f"Dimension '{f}' has more than {self.max_values} values, only the first are indexed.")
+            entry = DimensionValues([row[0] for row in rows[:self.max_values]], self.clock(),
+                                    truncated=len(rows) > self.max_values)
+            loaded[f] = entry
+            self.entries.pop(f, None)
+            if entry.size > self.max_bytes:
+                continue  # too large to keep, lookups will query the values again
+            while len(self.entries) > 0 and self.size + entry.size > self.max_bytes:
+                self.entries.popitem(last=False)
+            self.entries[f] = entry
+        return loaded
+
+    def is_stale(self, field: str) -> bool:
+        entry = self.entries.get(field)
+        return entry is None or self.clock() - entry.loaded_at >= self.get_refresh_seconds(field)
+
+    def lookup(self, field: str, prefix: str = '', limit: Optional[int] = None) -> List:
+        """values of a dimension that start with prefix, served from memory once loaded"""
+        if self.is_stale(field):
+            # values larger than the memory budget are not kept, but can be used for this lookup
+            entry = self.refresh(field)[field]
+        else:
+            entry = self.entries[field]
+            self.entries.move_to_end(field)
+        return entry.search(prefix, limit)
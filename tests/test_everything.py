@@ -1,11 +1,17 @@
 import random
 import sqlite3
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Dict, List
 
-from dotml.compiler import generate_sql_query
-from dotml.cube import load_cube_configs
+from dotml.compiler import generate_sql_query, generate_parameterized_sql_query, get_compiled_cube_fields, \
+    get_query_fingerprint
+from dotml.cube import load_cube_configs, load_model
+from dotml.planner import FanOutStrategy, fan_out_strategies, register_fan_out_strategy
+from dotml.registry import ModelRegistry
+from dotml.value_index import DimensionValueIndex, DimensionValues, get_indexed_dimensions
 
 
 class MyTestCase(unittest.TestCase):
@@ -68,10 +74,10 @@ class MyTestCase(unittest.TestCase):
         conn.close()
 
     @staticmethod
-    def execute_against_dummy_data(query: str) -> List[Dict]:
+    def execute_against_dummy_data(query: str, parameters=()) -> List[Dict]:
         conn = sqlite3.connect('shopy.db')
         c = conn.cursor()
-        c.execute(query)
+        c.execute(query, parameters)
         rows = c.fetchall()
         conn.close()
         return rows
@@ -142,6 +148,372 @@ class MyTestCase(unittest.TestCase):
         print(result)
         self.assertEqual(len(result), 3)
 
+    def test_canonical_query(self):
+        self.create_dummy_data()
+        cube_configs = load_cube_configs(dir_path="../cubes")
+        query = {
+            "fields": ["orders.booking_date_month", "orders.revenue", "orders_items.quantity"],
+            "filters": ["${orders.country_id} = '67'"],
+            "sorts": ["orders.booking_date_month"],
+        }
+        permuted_query = {
+            "fields": ["orders_items.quantity", "orders.revenue", "orders.booking_date_month"],
+            "filters": ["${orders.country_id} = '67'"],
+            "sorts": ["orders.booking_date_month"],
+        }
+        sql = generate_sql_query(cube_configs[0], query, canonical=True)
+        print(sql)
+        # compiling twice or with a different order of fields produces the exact same sql
+        self.assertEqual(sql, generate_sql_query(cube_configs[0], query, canonical=True))
+        self.assertEqual(sql, generate_sql_query(cube_configs[0], permuted_query, canonical=True))
+        self.assertNotIn('\n', sql)
+        self.assertTrue(sql.startswith(f"/* dotml fingerprint: {get_query_fingerprint(sql.split(' */ ', 1)[1])} */"))
+        result = self.execute_against_dummy_data(sql)
+        self.assertGreater(len(result), 0)
+
+        # the result columns are in canonical order, not in the requested order
+        sql = generate_sql_query(cube_configs[0], {"fields": ["orders.revenue", "orders.id"]}, canonical=True)
+        conn = sqlite3.connect('shopy.db')
+        columns = [d[0] for d in conn.execute(sql).description]
+        conn.close()
+        self.assertEqual(columns, ['id', 'revenue'])
+
+        # filters are ordered as well
+        query = {
+            "fields": ["orders.booking_date_month", "orders.revenue"],
+            "filters": ["${orders.country_id} = '67'", "${orders.id} > 10"],
+        }
+        permuted_query = {**query, "filters": ["${orders.id} > 10", "${orders.country_id} = '67'"]}
+        sql = generate_sql_query(cube_configs[0], query, canonical=True)
+        self.assertEqual(sql, generate_sql_query(cube_configs[0], permuted_query, canonical=True))
+        result = self.execute_against_dummy_data(sql)
+        self.assertGreater(len(result), 0)
+
+    def test_fan_out_strategies(self):
+        self.create_dummy_data()
+        cube_configs = load_cube_configs(dir_path="../cubes")
+        query = {
+            "fields": ["orders.booking_date_month", "orders.revenue", "orders.average_order_value",
+                       "orders_items.quantity"],
+            "filters": ["${orders.country_id} = '67'"],
+        }
+
+        # the planner prefers pre aggregating the order items, because only order dimensions are queried
+        sql = generate_sql_query(cube_configs[0], query)
+        self.assertTrue(sql.startswith('/* dotml fan-out strategy: pre_aggregate */'))
+
+        results = {}
+        for strategy in fan_out_strategies:
+            sql = generate_sql_query(cube_configs[0], {**query, "fan_out_strategy": strategy})
+            print(sql)
+            self.assertIn(f"/* dotml fan-out strategy: {strategy} */", sql)
+            rows = self.execute_against_dummy_data(
+                f"select booking_date_month, revenue, round(average_order_value, 6), quantity from ({sql})")
+            results[strategy] = sorted(rows)
+
+        self.assertGreater(len(results['dimension_cte']), 0)
+        self.assertEqual(results['dimension_cte'], results['pre_aggregate'])
+        self.assertEqual(results['dimension_cte'], results['symmetric_aggregate'])
+
+        # a strategy without all methods fails before it is registered
+        class IncompleteStrategy(FanOutStrategy):
+            name = 'incomplete'
+
+            def is_applicable(self, plan):
+                return True
+
+        with self.assertRaises(TypeError):
+            register_fan_out_strategy(IncompleteStrategy())
+        self.assertNotIn('incomplete', fan_out_strategies)
+
+
+    def test_fan_out_large_keys(self):
+        # symmetric aggregates lose precision for large keys and fractional values, the planner must not pick them
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE my_orders (id INTEGER PRIMARY KEY, booking_date DATE, country_id INTEGER, '
+                     'status TEXT, total REAL)')
+        conn.execute('CREATE TABLE my_order_items (id INTEGER PRIMARY KEY, order_id INTEGER, product_id INTEGER, '
+                     'quantity INTEGER, price INTEGER)')
+        for i in range(5):
+            order_id = 100000000 + i
+            conn.execute('INSERT INTO my_orders VALUES (?, ?, ?, ?, ?)',
+                         (order_id, '2023-01-01', 67, 'confirmed', 12.34))
+            for j in range(3):
+                conn.execute('INSERT INTO my_order_items VALUES (?, ?, ?, ?, ?)',
+                             (order_id * 10 + j, order_id, j, 1, 1))
+
+        cube_configs = load_cube_configs(dir_path="../cubes")
+        query = {"fields": ["orders_items.product", "orders.revenue"]}
+        sql = generate_sql_query(cube_configs[0], query)
+        self.assertNotIn('symmetric_aggregate', sql)
+        rows = conn.execute(f"select product, round(revenue, 6) from ({sql})").fetchall()
+        self.assertEqual(sorted(rows), [(0, 61.7), (1, 61.7), (2, 61.7)])
+
+        # it can still be requested explicitly
+        sql = generate_sql_query(cube_configs[0], {**query, "fan_out_strategy": "symmetric_aggregate"})
+        self.assertIn('/* dotml fan-out strategy: symmetric_aggregate */', sql)
+        conn.close()
+
+    def test_sampled_query(self):
+        self.create_dummy_data()
+        cube_configs = load_cube_configs(dir_path="../cubes")
+
+        query = {"fields": ["orders.country_id", "orders.revenue"], "sorts": ["orders.country_id"]}
+        full_result = self.execute_against_dummy_data(generate_sql_query(cube_configs[0], query))
+        sql = generate_sql_query(cube_configs[0], {**query, "sample": "30%"})
+        print(sql)
+        sampled_result = self.execute_against_dummy_data(sql)
+        self.assertLess(sum([r[1] for r in sampled_result]), sum([r[1] for r in full_result]))
+        # the sample is deterministic
+        self.assertEqual(sampled_result, self.execute_against_dummy_data(sql))
+
+        # scaled metrics estimate the full result
+        sql = generate_sql_query(cube_configs[0], {**query, "sample": {"percent": 50, "scale": True}})
+        scaled_result = self.execute_against_dummy_data(sql)
+        self.assertAlmostEqual(sum([r[1] for r in scaled_result]) / sum([r[1] for r in full_result]), 1, delta=0.5)
+
+        # joined cubes are sampled consistently, so all fan-out strategies still agree
+        query = {
+            "fields": ["orders.booking_date_month", "orders.revenue", "orders_items.quantity"],
+            "sample": {"percent": 50, "scale": True},
+        }
+        results = {}
+        for strategy in fan_out_strategies:
+            sql = generate_sql_query(cube_configs[0], {**query, "fan_out_strategy": strategy})
+            print(sql)
+            rows = self.execute_against_dummy_data(
+                f"select booking_date_month, round(revenue, 6), round(quantity, 6) from ({sql})")
+            results[strategy] = sorted(rows)
+        self.assertGreater(len(results['dimension_cte']), 0)
+        self.assertEqual(results['dimension_cte'], results['pre_aggregate'])
+        self.assertEqual(results['dimension_cte'], results['symmetric_aggregate'])
+
+
+    def test_sampled_query_dialects(self):
+        cube_configs = load_cube_configs(dir_path="../cubes")
+        query = {"fields": ["orders.booking_date_month", "orders.revenue", "orders_items.quantity"], "sample": 10}
+        # bigquery has no % operator
+        sql = generate_sql_query({**cube_configs[0], 'dialect': 'bigquery'}, query)
+        self.assertIn("abs(mod(farm_fingerprint(cast(orders.id as string)), 10000)) < 1000", sql)
+        self.assertNotIn('%', sql.replace("'%Y-%m-01'", ''))
+        sql = generate_sql_query({**cube_configs[0], 'dialect': 'snowflake'}, query)
+        self.assertIn("abs(hash(orders.id) % 10000) < 1000", sql)
+
+        # unknown or missing dialects are not guessed
+        with self.assertRaises(ValueError):
+            generate_sql_query({**cube_configs[0], 'dialect': 'snowflak'}, query)
+        with self.assertRaises(ValueError):
+            generate_sql_query({k: v for k, v in cube_configs[0].items() if k != 'dialect'}, query)
+
+        # without a single primary key, nothing can be sampled
+        cubes = [{**cube, 'dimensions': [{**d, 'primary_key': True} for d in cube['dimensions']]}
+                 for cube in cube_configs[0]['cubes']]
+        with self.assertRaises(ValueError):
+            generate_sql_query({**cube_configs[0], 'cubes': cubes}, {"fields": ["orders.revenue"], "sample": 10})
+
+        # the sqlite hash only works for numeric keys, text keys would sample every row
+        cubes = [{**cube, 'dimensions': [{k: v for k, v in d.items() if k != 'type'} for d in cube['dimensions']]}
+                 for cube in cube_configs[0]['cubes']]
+        with self.assertRaises(ValueError):
+            generate_sql_query({**cube_configs[0], 'cubes': cubes, 'dialect': 'sqlite'},
+                               {"fields": ["orders.revenue"], "sample": 10})
+        sql = generate_sql_query({**cube_configs[0], 'cubes': cubes, 'dialect': 'postgres'}, query)
+        self.assertIn("hashtext(cast(orders.id as text))", sql)
+
+    def test_dimension_value_index(self):
+        self.create_dummy_data()
+        cube_configs = load_cube_configs(dir_path="../cubes")
+        self.assertEqual(get_indexed_dimensions(cube_configs[0]), ['orders.country_id', 'orders_items.product'])
+
+        executed = []
+        now = [0.0]
+
+        def execute(sql: str):
+            executed.append(sql)
+            return self.execute_against_dummy_data(sql)
+
+        index = DimensionValueIndex(cube_configs[0], execute, refresh_seconds=60, clock=lambda: now[0])
+        countries = index.lookup('orders.country_id')
+        expected = self.execute_against_dummy_data(
+            "select distinct country_id from my_orders where status = 'confirmed' order by 1")
+        self.assertEqual(countries, [r[0] for r in expected])
+        self.assertTrue(all([str(c).startswith('6') for c in index.lookup('orders.country_id', '6')]))
+        self.assertEqual(len(index.lookup('orders.country_id', '6', limit=2)), 2)
+        self.assertEqual(index.lookup('orders.country_id', 'x'), [])
+        # served from memory until the refresh interval passed
+        self.assertEqual(len(executed), 1)
+        self.assertEqual(executed[0], index.get_values_query('orders.country_id'))
+        self.assertIn('limit 10001', executed[0])
+        now[0] = 61
+        index.lookup('orders.country_id')
+        self.assertEqual(len(executed), 2)
+
+        # the least recently used dimension is dropped when the memory budget is exceeded
+        index.lookup('orders_items.product')
+        index.lookup('orders.country_id')
+        self.assertEqual(list(index.entries), ['orders_items.product', 'orders.country_id'])
+        index.max_bytes = max([entry.size for entry in index.entries.values()])
+        index.refresh('orders.country_id')
+        self.assertEqual(list(index.entries), ['orders.country_id'])
+
+        # values larger than the memory budget cost one query per lookup
+        index.max_bytes = 1
+        index.refresh('orders.country_id')
+        self.assertEqual(len(index.entries), 0)
+        executed.clear()
+        self.assertEqual(index.lookup('orders.country_id'), countries)
+        index.lookup('orders.country_id')
+        self.assertEqual(len(executed), 2)
+
+        # values keep their type, numbers stay in numeric order, the search is case insensitive
+        values = DimensionValues([100, 7, None, 60, 1], 0.0)
+        self.assertEqual(values.values, (1, 7, 60, 100))
+        self.assertEqual(values.search('1'), [1, 100])
+        self.assertEqual(values.search('', limit=2), [1, 7])
+        values = DimensionValues(['b', 'Apple', 'apricot', 'Banana'], 0.0)
+        self.assertEqual(values.search('a'), ['Apple', 'apricot'])
+        self.assertEqual(values.search('B', limit=1), ['b'])
+
+        # values beyond max_values are not loaded, which is recorded
+        self.assertFalse(index.refresh('orders.country_id')['orders.country_id'].truncated)
+        index.max_values = 3
+        truncated = index.refresh('orders.country_id')['orders.country_id']
+        self.assertTrue(truncated.truncated)
+        self.assertEqual(len(truncated.values), 3)
+        index.max_values = len(countries)
+        self.assertFalse(index.refresh('orders.country_id')['orders.country_id'].truncated)
+
+        with self.assertRaises(ValueError):
+            index.lookup('orders.id')
+
+
+    def test_parameterized_query(self):
+        self.create_dummy_data()
+        cube_configs = load_cube_configs(dir_path="../cubes")
+        for fields in (["orders.booking_date_month", "orders.revenue"],
+                       ["orders.booking_date_month", "orders.revenue", "orders_items.quantity"]):
+            query = {"fields": fields, "filters": ["${orders.country_id} = 67", "${orders.id} > 20"], "limit": 10}
+            sql, parameters = generate_parameterized_sql_query(cube_configs[0], query)
+            print(sql)
+            self.assertNotIn('67', sql)
+            self.assertEqual(parameters, [67, 20, 10])
+            self.assertEqual(self.execute_against_dummy_data(sql, parameters),
+                             self.execute_against_dummy_data(generate_sql_query(cube_configs[0], query)))
+
+            # other values compile to the same sql
+            other_query = {**query, "filters": ["${orders.country_id} = 68", "${orders.id} > 1"], "limit": 5}
+            other_sql, other_parameters = generate_parameterized_sql_query(cube_configs[0], other_query)
+            self.assertEqual(sql, other_sql)
+            self.assertEqual(other_parameters, [68, 1, 5])
+
+        sql, parameters = generate_parameterized_sql_query(
+            cube_configs[0], {"fields": ["orders.revenue"], "filters": ["${orders.country_id} = 'it''s'"]}, 'named')
+        self.assertIn('= :p1', sql)
+        self.assertEqual(parameters, {'p1': "it's", 'p2': 5000})
+        self.assertEqual(self.execute_against_dummy_data(sql, parameters), [(None,)])
+
+        # literals that belong to a type stay in the sql
+        for fil, kept, parameters in (
+                ("cast(${orders.country_id} as varchar(10)) = '67'", "varchar(10)", ['67', 5000]),
+                ("${orders.booking_date_day} >= date '2019-01-01'", "date '2019-01-01'", [5000]),
+                ("${orders.booking_date_day} >= date('now', '-7 day') - interval '7' day", "interval '7' day",
+                 ['now', '-7 day', 5000]),
+                ("cast(${orders.country_id} as decimal(10, 2)) > 1.5", "decimal(10, 2)", [1.5, 5000])):
+            sql, sql_parameters = generate_parameterized_sql_query(
+                cube_configs[0], {"fields": ["orders.revenue"], "filters": [fil]})
+            self.assertIn(kept, sql)
+            self.assertEqual(sql_parameters, parameters)
+
+        sql, _ = generate_parameterized_sql_query(cube_configs[0], {"fields": ["orders.booking_date_month"]}, 'format')
+        self.assertIn("strftime('%%Y-%%m-01'", sql)
+        self.assertTrue(sql.endswith('limit %s'))
+
+
+    def test_model_registry(self):
+        loaded = []
+
+        def loader(model_id: str):
+            loaded.append(model_id)
+            time.sleep(0.05)
+            return load_model("shopy", dir_path="../cubes")
+
+        now = [0.0]
+        registry = ModelRegistry(loader, clock=lambda: now[0])
+        # concurrent first uses load the model once
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            models = list(executor.map(registry.get, ['tenant_a'] * 4))
+        self.assertEqual(loaded, ['tenant_a'])
+        self.assertTrue(all([m is models[0] for m in models]))
+        self.assertIn('booking_date_month', models[0].cube_fields['orders'])
+        sql = registry.generate_sql_query('tenant_a', {"fields": ["orders.revenue"]})
+        self.assertIn('sum(orders.total)', sql)
+
+        # queries reuse the compiled fields of the model, without changing them
+        size = models[0].size
+        query = {"fields": ["orders.booking_date_year", "orders.revenue", "orders_items.quantity"],
+                 "filters": ["${orders.country_id} = '67'"], "sorts": ["orders.booking_date_year"]}
+        sql = registry.generate_sql_query('tenant_a', query)
+        self.assertEqual(sql, generate_sql_query(models[0].cubes_config, query))
+        self.assertEqual(registry.generate_sql_query('tenant_a', query), sql)
+        self.assertIn('booking_date_year', models[0].cube_fields['orders'].resolved)
+        self.assertGreater(models[0].size, size)
+        self.assertEqual(models[0].cube_fields['orders']['revenue']['sql'], 'sum(${table}.total)')
+
+        # least recently used models are evicted when the memory budget is exceeded
+        registry.get('tenant_b')
+        registry.get('tenant_a')
+        registry.max_bytes = models[0].size
+        registry.get('tenant_c')
+        self.assertEqual(list(registry.models), ['tenant_c'])
+        registry.max_bytes = 3 * models[0].size
+        registry.get('tenant_a')
+        self.assertEqual(loaded, ['tenant_a', 'tenant_b', 'tenant_c', 'tenant_a'])
+
+        # idle models are evicted
+        registry.max_idle_seconds = 60
+        now[0] = 100
+        registry.get('tenant_b')
+        self.assertEqual(list(registry.models), ['tenant_b'])
+
+        with self.assertRaises(ValueError):
+            ModelRegistry(dir_path="../cubes").get('../cubes/shopy')
+        self.assertEqual(len(ModelRegistry(dir_path="../cubes").get('shopy').cubes_config['cubes']), 2)
+
+
+    def test_lazy_variants(self):
+        cube = {
+            'name': 'bookings',
+            'table': 'bookings',
+            'dimensions': [
+                {'name': 'id', 'sql': '${table}.id', 'primary_key': True},
+                {'name': 'booking_date', 'sql': "date_trunc('${time_frame}', ${table}.booked_at)",
+                 'variants': [{'time_frame': ['day', 'week', 'month', 'year']}]},
+            ],
+            'metrics': [
+                {'name': 'amount', 'sql': 'sum(${table}.amount_${currency} * ${channel})',
+                 'variants': [{'currency': ['usd', 'eur', 'chf']},
+                              {'channel': [{'web': 'web_share'}, {'in_store': 'store_share'}]}]},
+            ],
+        }
+        cube_fields = get_compiled_cube_fields(cube)
+        self.assertEqual(len(cube_fields), 1 + 4 + 3 * 2)
+        self.assertEqual(cube_fields['booking_date_month']['sql'], "date_trunc('month', ${table}.booked_at)")
+        self.assertEqual(cube_fields['amount_eur_in_store']['sql'], 'sum(${table}.amount_eur * store_share)')
+        self.assertNotIn('amount_eur', cube_fields)
+        self.assertNotIn('booking_date', cube_fields)
+        self.assertNotIn('booking_date_hour', cube_fields)
+        # only the requested variants are built, listing them is lazy
+        self.assertEqual(sorted(cube_fields.resolved), ['amount_eur_in_store', 'booking_date_month'])
+        names = iter(cube_fields)
+        self.assertEqual([next(names) for _ in range(3)], ['id', 'booking_date_day', 'booking_date_week'])
+        self.assertIn('amount_chf_web', list(cube_fields))
+
+        sql = generate_sql_query({'cubes': [cube]}, {'fields': ['bookings.booking_date_week', 'bookings.amount_usd_web']})
+        self.assertIn("date_trunc('week', bookings.booked_at) as booking_date_week", sql)
+        self.assertIn("sum(bookings.amount_usd * web_share) as amount_usd_web", sql)
+        with self.assertRaises(ValueError):
+            generate_sql_query({'cubes': [cube]}, {'fields': ['bookings.amount_usd']})
+
 
 if __name__ == '__main__':
     unittest.main()